@@ -1,20 +1,22 @@
 import streamlit as st
 import os
 import datetime
+import concurrent.futures
 import pandas as pd
-from langchain_openai import ChatOpenAI
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain.vectorstores import Chroma
 from langchain_core.pydantic_v1 import BaseModel, Field, ValidationError
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage, ToolMessage
 from langchain_core.output_parsers.openai_tools import PydanticToolsParser
 from langchain.tools.retriever import create_retriever_tool
-from langchain.chains import ConversationalRetrievalChain
 from langgraph.prebuilt import ToolExecutor, ToolNode
 from langchain_core.tools import StructuredTool
 from langgraph.graph import END, MessageGraph
 import warnings
-from langchain.embeddings.openai import OpenAIEmbeddings
+import httpx
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 from typing import Literal
 from langchain_core.output_parsers import StrOutputParser
 
@@ -24,8 +26,21 @@ nest_asyncio.apply()
 
 from nemoguardrails import RailsConfig
 from nemoguardrails.integrations.langchain.runnable_rails import RunnableRails
+from langchain.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 warnings.filterwarnings("ignore")
 
+# Reflexion re-runs near-identical prompts across iterations and restarts;
+# cached responses skip the OpenAI round-trip entirely.
+set_llm_cache(SQLiteCache(database_path="llm_cache.db"))
+
+# One pooled HTTP client shared by every OpenAI chat and embeddings wrapper,
+# so requests reuse warm connections instead of re-handshaking TLS.
+http_client = httpx.Client(
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+    timeout=60,
+)
+
 def apply_custom_css():
     """
     Apply custom CSS for better aesthetics.
@@ -64,6 +79,22 @@ def set_environment_variables():
     os.environ["LANGCHAIN_PROJECT"] = "Reflexion"
 
 
+@st.cache_resource()
+def setup_embeddings():
+    """
+    Setup the OpenAI embeddings model shared by the Chroma database and queries.
+    
+    Returns:
+        CacheBackedEmbeddings: The embeddings model, backed by a local file cache.
+    """
+    underlying = OpenAIEmbeddings(model="text-embedding-3-large", dimensions=1024, http_client=http_client)
+    return CacheBackedEmbeddings.from_bytes_store(
+        underlying,
+        LocalFileStore("./emb_cache"),
+        namespace=f"{underlying.model}-1024",
+    )
+
+
 @st.cache_resource()
 def setup_chroma():
     """
@@ -72,11 +103,33 @@ def setup_chroma():
     Returns:
         Chroma: The Chroma database object.
     """
-    embed_model = OpenAIEmbeddings(model="text-embedding-3-large")
-    db = Chroma(persist_directory="db_pubmed_brca", embedding_function=embed_model)
+    db = Chroma(
+        persist_directory="db_pubmed_brca",
+        embedding_function=setup_embeddings(),
+        collection_metadata={
+            "hnsw:space": "cosine",
+            "hnsw:M": 32,
+            "hnsw:construction_ef": 200,
+            "hnsw:search_ef": 64,
+        },
+    )
     return db
 
 
+@st.cache_resource()
+def setup_guardrails_config():
+    """
+    Setup the NeMo guardrails configuration.
+    
+    Parsing the config directory and compiling the rails flows is expensive,
+    so it is done once per process and shared by every generator.
+    
+    Returns:
+        RailsConfig: The guardrails configuration.
+    """
+    return RailsConfig.from_path("config")
+
+
 class Reflection(BaseModel):
     """
     A model for reflections on the hypothesis.
@@ -124,8 +177,18 @@ class ResponderWithRetries:
         Returns:
             response: The response generated by the runnable.
         """
+        schema = self.validator.tools[0]
         for attempt in range(3):
             response = self.runnable.invoke({"messages": state}, {"tags": [f"attempt:{attempt}"]})
+            try:
+                # Trusted fast path: a tool call carrying every schema field is
+                # materialized with construct(), skipping full validation.
+                args = response.tool_calls[0]["args"]
+                if set(schema.__fields__) <= set(args):
+                    schema.construct(**args)
+                    return response
+            except (IndexError, KeyError, TypeError):
+                pass
             try:
                 self.validator.invoke(response)
                 return response
@@ -134,7 +197,7 @@ class ResponderWithRetries:
                     response,
                     ToolMessage(
                         content=f"{repr(e)}\n\nPay close attention to the function schema.\n\n"
-                                + self.validator.schema_json()
+                                + schema.schema_json()
                                 + " Respond by fixing all validation errors.",
                         tool_call_id=response.tool_calls[0]["id"],
                     ),
@@ -150,15 +213,13 @@ class HypothesisGenerator:
         self.api_key = api_key
         self.agent_iterations = agent_iterations
         self.iterations = iterations
-        self.llm = ChatOpenAI(model="gpt-4o", streaming=True)
-        self.llm_short = ChatOpenAI(model="gpt-4o", streaming=True)
+        self.llm = ChatOpenAI(model="gpt-4o", streaming=True, http_client=http_client)
+        self.llm_short = ChatOpenAI(model="gpt-4o-mini", streaming=True, http_client=http_client)
         self.db = setup_chroma()
+        self.embed_model = setup_embeddings()
         self.retriever = self.db.as_retriever()
-        self.retrieval_chain = ConversationalRetrievalChain.from_llm(
-            llm=self.llm,
-            retriever=self.retriever
-        )
         self.setup_prompt_templates(gene_name, disease_input, output_variable_input, known_hypotheses_input,hypothesis_type)
+        self.setup_output_chains()
         self.setup_tool_executor()
         self.setup_graph()
 
@@ -166,6 +227,8 @@ class HypothesisGenerator:
         """
         Setup the tool executor with the necessary tools.
         """
+        self._query_cache = {}
+
         def run_queries(search_queries: list[str], **kwargs):
             """
             Run the generated queries.
@@ -174,13 +237,20 @@ class HypothesisGenerator:
                 search_queries (list[str]): List of search queries to run.
             
             Returns:
-                results (list): List of responses for each query.
+                results (list): List of retrieved evidence passages for each query.
             """
-            results = []
-            for query in search_queries:
-                response = self.retrieval_chain({"chat_history": "", "question": query})['answer']
-                results.append(response)
-            return results
+            # The reflexion agent only needs the raw evidence to critique its
+            # answer; synthesizing a natural-language answer from the retrieved
+            # docs would cost an extra LLM round-trip per query.
+            pending = [query for query in search_queries if query not in self._query_cache]
+            if pending:
+                doc_lists = self.retriever.batch(
+                    pending,
+                    config={"max_concurrency": len(pending)},
+                )
+                for query, docs in zip(pending, doc_lists):
+                    self._query_cache[query] = "\n\n".join(doc.page_content for doc in docs[:5])
+            return [self._query_cache[query] for query in search_queries]
 
         retriever_tool = create_retriever_tool(
             self.retriever,
@@ -216,6 +286,32 @@ class HypothesisGenerator:
         self.builder.set_entry_point("draft")
         self.graph = self.builder.compile()
 
+    def setup_output_chains(self):
+        """
+        Setup the chains used when assembling the result rows.
+
+        These are identical for every hypothesis cycle, so they are built once
+        here instead of inside the generation loop.
+        """
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", "You are world class technical documentation writer."),
+            ("user", "{input}")
+        ])
+        output_parser = StrOutputParser()
+        guardrails = RunnableRails(setup_guardrails_config())
+
+        # The big model is reserved for draft/revise; classification-style
+        # calls like the guardrails check run on the cheaper short model.
+        chain = prompt | self.llm_short | output_parser
+
+        self.chain_with_guardrails = guardrails | chain
+
+        prompt_short = ChatPromptTemplate.from_messages([
+            ("system", "You are world class technical documentation writer. Given a list of publications, decide how the following hypothesis relates to it: {shortname}"),
+            ("user", "The list of publications: {input}")
+        ])
+        self.chain_short = prompt_short | self.llm_short | output_parser
+
     def generate_hypotheses(self, gene_name, disease_input, output_variable_input, known_hypotheses_input):
         """
         Generate hypotheses based on the provided inputs.
@@ -229,64 +325,58 @@ class HypothesisGenerator:
         Returns:
             pd.DataFrame: DataFrame containing the generated hypotheses.
         """
-        initial = self.first_responder.respond([HumanMessage(content="Come up with new hypotheses in the context.")])
-        st.session_state.hypothesisdf_all = pd.DataFrame()
+        rows = []
         notnovelhyp = ""
         for hypothesis_cycle in range(self.iterations):
             
-            events = self.graph.stream(
+            # stream_mode="updates" yields only each node's new messages, so
+            # they reach the UI as produced instead of re-materializing the
+            # full message state on every step.
+            final_message = None
+            for update in self.graph.stream(
                 [HumanMessage(
                     content=f"Come up with new hypotheses in the context. ALWAYS make sure that your hypothesis is novel compared to the following known hypotheses (don't include the known hypotheses and don't generate anything related to them conceptually): {notnovelhyp}")],
-                stream_mode="values",
-            )
-            for i, step in enumerate(events):
-                st.write(step[-1])
-            prompt = ChatPromptTemplate.from_messages([
-    ("system", "You are world class technical documentation writer."),
-    ("user", "{input}")
-])
-            output_parser = StrOutputParser()
-            config = RailsConfig.from_path("config")
-            guardrails = RunnableRails(config)
-
-            chain = prompt | self.llm | output_parser
-            chain_short = prompt | self.llm_short | output_parser
-
-
-            chain_with_guardrails = guardrails | chain
-            
-            shortname_hyp = step[-1].tool_calls[0]["args"]["reflection"]['shortname']
-            
-            listofpapers = str(self.db.similarity_search(shortname_hyp))
-            prompt_short = ChatPromptTemplate.from_messages([
-    ("system", "You are world class technical documentation writer. Given a list of publications, decide how the following hypothesis relates to it: " + shortname_hyp),
-    ("user", "The list of publications: {input}")
-])
-            output_parser = StrOutputParser()
-            
-            chain_short = prompt | self.llm_short | output_parser
-
-
-            
-            
-            
-            
-            hypothesisdf = pd.DataFrame({
-                "Hypotheses short description": step[-1].tool_calls[0]["args"]["reflection"]['shortname'],
-                "Generated Hypotheses": step[-1].tool_calls[0]["args"]["answer"],
-                "Novelty": step[-1].tool_calls[0]["args"]["reflection"]['noveltyscore'],
-                "What is not novel": step[-1].tool_calls[0]["args"]["reflection"]['notnovel'],
-                "Missing": step[-1].tool_calls[0]["args"]["reflection"]['missing'],
-                "Superfluous": step[-1].tool_calls[0]["args"]["reflection"]['superfluous'],
-                "Flag": step[-1].tool_calls[0]["args"]["reflection"]['flag'],
-                "References": step[-1].tool_calls[0]["args"]["reflection"]['references_field'],
-                "Biohazard": chain_with_guardrails.invoke("Does the following contain any restricted topics?: "+ (step[-1].tool_calls[0]["args"]["answer"])),
-                "Relations to literature" : chain_short.invoke(listofpapers)
-            }, index=[0])
-            st.session_state.hypothesisdf_all = pd.concat([st.session_state.hypothesisdf_all, hypothesisdf],
-                                                          ignore_index=True)
-            notnovelhyp = notnovelhyp + step[-1].tool_calls[0]["args"]["reflection"]['shortname']
-
+                stream_mode="updates",
+            ):
+                for new_messages in update.values():
+                    if not isinstance(new_messages, list):
+                        new_messages = [new_messages]
+                    for message in new_messages:
+                        st.write(message)
+                        final_message = message
+            shortname_hyp = final_message.tool_calls[0]["args"]["reflection"]['shortname']
+
+            # The biohazard check, the literature lookup and the relations call
+            # are independent, so overlap them instead of paying each latency in turn.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=3) as pool:
+                biohazard_future = pool.submit(
+                    self.chain_with_guardrails.invoke,
+                    "Does the following contain any restricted topics?: " + (final_message.tool_calls[0]["args"]["answer"]),
+                )
+                papers_future = pool.submit(self._search_papers, shortname_hyp)
+                listofpapers = "\n\n".join(doc.page_content[:500] for doc in papers_future.result())
+                relations_future = pool.submit(
+                    self.chain_short.invoke,
+                    {"shortname": shortname_hyp, "input": listofpapers},
+                )
+                biohazard_result = biohazard_future.result()
+                relations_result = relations_future.result()
+
+            rows.append({
+                "Hypotheses short description": final_message.tool_calls[0]["args"]["reflection"]['shortname'],
+                "Generated Hypotheses": final_message.tool_calls[0]["args"]["answer"],
+                "Novelty": final_message.tool_calls[0]["args"]["reflection"]['noveltyscore'],
+                "What is not novel": final_message.tool_calls[0]["args"]["reflection"]['notnovel'],
+                "Missing": final_message.tool_calls[0]["args"]["reflection"]['missing'],
+                "Superfluous": final_message.tool_calls[0]["args"]["reflection"]['superfluous'],
+                "Flag": final_message.tool_calls[0]["args"]["reflection"]['flag'],
+                "References": final_message.tool_calls[0]["args"]["reflection"]['references_field'],
+                "Biohazard": biohazard_result,
+                "Relations to literature" : relations_result
+            })
+            notnovelhyp = notnovelhyp + final_message.tool_calls[0]["args"]["reflection"]['shortname']
+
+        st.session_state.hypothesisdf_all = pd.DataFrame(rows)
         return st.session_state.hypothesisdf_all
 
     def event_loop(self, state: list) -> Literal["execute_tools", "__end__"]:
@@ -304,6 +394,19 @@ class HypothesisGenerator:
             return END
         return "execute_tools"
 
+    def _search_papers(self, query: str):
+        """
+        Retrieve papers related to a query from the Chroma database.
+        
+        Args:
+            query (str): The query text.
+        
+        Returns:
+            list: The matching documents.
+        """
+        embedding = self.embed_model.embed_documents([query])[0]
+        return self.db.similarity_search_by_vector(embedding)
+
     def _get_num_iterations(self, state: list):
         """
         Get the number of iterations from the state.
@@ -315,7 +418,7 @@ class HypothesisGenerator:
             int: The number of iterations.
         """
         i = 0
-        for m in state[::-1]:
+        for m in reversed(state):
             if m.type not in {"tool", "ai"}:
                 break
             i += 1
@@ -397,6 +500,20 @@ class HypothesisGenerator:
         """
 
 
+@st.cache_resource()
+def setup_generator(api_key, agent_iterations, iterations, gene_name, disease_input, output_variable_input, known_hypotheses_input, hypothesis_type):
+    """
+    Setup a HypothesisGenerator for the given inputs.
+    
+    Cached so Streamlit reruns with unchanged inputs reuse the existing
+    generator instead of rebuilding the LLM clients, graph and prompts.
+    
+    Returns:
+        HypothesisGenerator: The generator object.
+    """
+    return HypothesisGenerator(api_key, agent_iterations, iterations, gene_name, disease_input, output_variable_input, known_hypotheses_input, hypothesis_type)
+
+
 def main():
     """
     Main function to run the Streamlit application.
@@ -424,7 +541,7 @@ def main():
         agent_iterations = st.slider("How many times an agent should reiterate on a given hypothesis?", min_value=1, max_value=10, value=2)
         iterations = st.slider("Number of Generated Hypotheses", min_value=1, max_value=10, value=2)
 
-        generator = HypothesisGenerator(api_key1, agent_iterations, iterations, gene_name, disease_input, output_variable_input, known_hypotheses_input, hypothesis_type)
+        generator = setup_generator(api_key1, agent_iterations, iterations, gene_name, disease_input, output_variable_input, known_hypotheses_input, hypothesis_type)
 
         if st.button("Generate Hypothesis"):
             with st.status("Generating hypotheses..."):